@@ -24,8 +24,9 @@
 Manages lists of rectangular objects and quickly finds them.
 """
 
-import bisect
-import operator
+import array
+import math
+from bisect import bisect_left, bisect_right
 
 
 Left   = 0
@@ -34,13 +35,36 @@ Right  = 2
 Bottom = 3
 
 
+def _hilbert(x, y, side=256):
+    """Returns the distance along a Hilbert curve filling a side x side grid
+    at the integer point (x, y).
+
+    side must be a power of two, x and y must be in range(side).
+
+    """
+    d = 0
+    s = side >> 1
+    while s:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        if not ry:
+            if rx:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
 class Rectangles:
     """
     Manages a list of rectangular objects and quickly finds objects at
     some point, in some rectangle or intersecting some rectangle.
 
-    The implementation uses four lists of the objects sorted on either
-    coordinate, so retrieval is fast.
+    The implementation packs the objects and their coordinates in flat
+    lists and keeps for every side the object indices sorted on the
+    coordinate of that side, so retrieval is fast.
 
     Bulk adding is done in the constructor or via the bulk_add() method (which
     clears the indexes, that are recreated on first search).  Single objects
@@ -58,8 +82,15 @@ class Rectangles:
         bulk_add() is called on those objects.
 
         """
-        self._items = {} # maps object to the result of func(object)
-        self._index = {} # maps side to indices, objects (index=coordinate of that side)
+        self._items = {}    # maps object to the result of get_coords(object)
+        self._objs = None   # list of objects; the position is the object's index
+        self._coords = None # four coordinate arrays, one per side, parallel to _objs
+        self._ids = None    # maps object to its index in _objs
+        self._widths = None  # array of widths, parallel to _objs
+        self._heights = None # array of heights, parallel to _objs
+        self._index = {}    # maps side to a (values, order) tuple: the sorted
+                            # coordinates of that side and the object indices
+        self._cache = {}    # memoizes recent at() and nearest() results
         if objects:
             self.bulk_add(objects)
 
@@ -77,11 +108,22 @@ class Rectangles:
         """Adds an object to our list. Keeps the index intact."""
         if obj in self._items:
             return
+        self._cache.clear()
         self._items[obj] = coords = self.get_coords(obj)
-        for side, (indices, objects) in self._index.items():
-            i = bisect.bisect_left(indices, coords[side])
-            indices.insert(i, coords[side])
-            objects.insert(i, obj)
+        if self._objs is not None:
+            i = len(self._objs)
+            self._objs.append(obj)
+            for side in (Left, Top, Right, Bottom):
+                self._coords[side].append(coords[side])
+            self._ids[obj] = i
+            if self._widths is not None:
+                self._widths.append(coords[Right] - coords[Left])
+            if self._heights is not None:
+                self._heights.append(coords[Bottom] - coords[Top])
+            for side, (values, order) in self._index.items():
+                j = bisect_left(values, coords[side])
+                values.insert(j, coords[side])
+                order.insert(j, i)
 
     def bulk_add(self, objects):
         """Adds many new items to the index using the function given in the constructor.
@@ -90,28 +132,42 @@ class Rectangles:
 
         """
         self._items.update((obj, self.get_coords(obj)) for obj in objects)
+        self._objs = self._coords = self._ids = None
+        self._widths = self._heights = None
         self._index.clear()
+        self._cache.clear()
 
     def remove(self, obj):
         """Removes an object from our list. Keeps the index intact."""
+        self._cache.clear()
         del self._items[obj]
-        for indices, objects in self._index.values():
-            i = objects.index(obj)
-            del objects[i]
-            del indices[i]
+        if self._objs is not None:
+            i = self._ids.pop(obj)
+            self._objs[i] = None    # the coordinates at index i become stale
+            for values, order in self._index.values():
+                j = order.index(i)
+                del values[j]
+                del order[j]
 
     def clear(self):
         """Empties the list of items."""
         self._items.clear()
+        self._objs = self._coords = self._ids = None
+        self._widths = self._heights = None
         self._index.clear()
+        self._cache.clear()
 
     def at(self, x, y):
         """Returns a set() of objects that are touched by the given point."""
-        return self._test(
-            (self._smaller, Top, y),
-            (self._larger, Bottom, y),
-            (self._smaller, Left, x),
-            (self._larger, Right, x))
+        try:
+            result = self._cache['at', x, y]
+        except KeyError:
+            result = self._remember(('at', x, y), self._test(
+                (self._smaller, Top, y),
+                (self._larger, Bottom, y),
+                (self._smaller, Left, x),
+                (self._larger, Right, x)))
+        return set(result)
 
     def inside(self, left, top, right, bottom):
         """Returns a set() of objects that are fully in the given rectangle."""
@@ -139,39 +195,62 @@ class Rectangles:
                 # ...
 
         """
-        coords = self._items[obj]
-        return coords[Right] - coords[Left]
+        if self._widths is None:
+            if self._objs is None:
+                self._build()
+            l, r = self._coords[Left], self._coords[Right]
+            self._widths = array.array('d', (r[i] - l[i] for i in range(len(l))))
+        return self._widths[self._ids[obj]]
 
     def height(self, obj):
         """Return the height of the specified object. See also width()."""
-        coords = self._items[obj]
-        return coords[Bottom] - coords[Top]
+        if self._heights is None:
+            if self._objs is None:
+                self._build()
+            t, b = self._coords[Top], self._coords[Bottom]
+            self._heights = array.array('d', (b[i] - t[i] for i in range(len(t))))
+        return self._heights[self._ids[obj]]
 
     def closest(self, obj, side):
         """Returns the object closest to the given one, going to the given side."""
+        opposite = side ^ 2     # e.g. the right side when going left
+        lat_hi = side ^ 1 | 2   # the two sides of the lateral axis
+        lat_lo = side ^ 1 & 2
         coords = self._items[obj]
-        pos = coords[side^2]
-        lat = (coords[side^1|2] - coords[side^1&2]) / 2.0
-        direction = -1 if side < Right else 1
-        indices, objects = self._sorted(side^2)
-        i = objects.index(obj)
-        mindist = indices[-1]
-        result = []
-        for other in objects[i+direction::direction]:
-            coords = self._items[other]
-            pos1 = coords[side^2]
-            d = abs(pos1 - pos)
+        pos = coords[opposite]
+        lat = (coords[lat_hi] - coords[lat_lo]) / 2.0
+        direction = (side & 2) - 1  # -1 for Left/Top, 1 for Right/Bottom
+        values, order = self._sorted(opposite)
+        # scan away from our own position; neighbors with the same coordinate
+        # can never qualify (their distance is 0), so they may be skipped
+        if direction == -1:
+            start = bisect_left(values, pos) - 1
+            if start < 0:
+                return
+        else:
+            start = bisect_right(values, pos)
+        # the total distance of a candidate is at least its axial distance d,
+        # so the scan may stop as soon as d exceeds the best total found
+        mindist = math.inf
+        poscol = self._coords[opposite]
+        hicol = self._coords[lat_hi]
+        locol = self._coords[lat_lo]
+        best = None
+        stop = -1 if direction < 0 else len(order)
+        for k in range(start, stop, direction):
+            other = order[k]
+            d = abs(poscol[other] - pos)
             if d > mindist:
                 break
-            lat1 = (coords[side^1|2] - coords[side^1&2]) / 2.0
+            lat1 = (hicol[other] - locol[other]) / 2.0
             dlat = abs(lat1 - lat)
             if dlat < d:
                 dist = dlat + d  # manhattan dist
-                result.append((other, dist))
-                mindist = min(mindist, dist)
-        if result:
-            result.sort(key=lambda r: r[1])
-            return result[0][0]
+                if dist < mindist:
+                    mindist = dist
+                    best = other
+        if best is not None:
+            return self._objs[best]
 
     def nearest(self, x, y):
         """Return the object with the shortest distance to the point x, y.
@@ -180,59 +259,31 @@ class Rectangles:
         touch the point (x, y). If there are no objects, None is returned.
 
         """
-        i = self._items
-
-        left = self._larger(Left, x)            # closest one is first
-        right = self._smaller(Right, x)         # closest one is last
-        top = self._larger(Top, y)              # closest one is first
-        bottom = self._smaller(Bottom, y)       # closest one is last
-
-        result = []
-
-        # first find adjacent rectangles. For each side, as soon as one is
-        # found, don't look further for that side. Only save rectangles that are
-        # closer but not adjacent, they could be closer on another side.
-        left_over = 0
-        for o in left:
-            if o not in top and o not in bottom:
-                result.append((i[o][Left] - x, o))
-                break
-            left_over += 1
-        top_over = 0
-        for o in top:
-            if o not in left and o not in right:
-                result.append((i[o][Top] - y, o))
-                break
-            top_over += 1
-        right_over = 0
-        for o in right[::-1]:
-            if o not in top and o not in bottom:
-                result.append((x - i[o][Right], o))
-                break
-            right_over -= 1
-        bottom_over = 0
-        for o in bottom[::-1]:
-            if o not in left and o not in right:
-                result.append((y - i[o][Bottom], o))
-                break
-            bottom_over -= 1
-        # at most 4 rectangles are found, the closest one on each edge.
-        # Now look for rectangles that could be closer at the corner.
-        if left_over and top_over:
-            for o in set(left[:left_over]).intersection(top[:top_over]):
-                result.append((i[o][Left] - x + i[o][Top] - y, o))
-        if top_over and right_over:
-            for o in set(top[:top_over]).intersection(right[right_over:]):
-                result.append((i[o][Top] - y + x - i[o][Right], o))
-        if left_over and bottom_over:
-            for o in set(left[:left_over]).intersection(bottom[bottom_over:]):
-                result.append((i[o][Left] - x + y - i[o][Bottom], o))
-        if bottom_over and right_over:
-            for o in set(bottom[bottom_over:]).intersection(right[right_over:]):
-                result.append((y - i[o][Bottom] + x - i[o][Right], o))
-
-        if result:
-            return min(result, key=operator.itemgetter(0))[1]
+        try:
+            return self._cache['nearest', x, y]
+        except KeyError:
+            pass
+        if self._objs is None:
+            self._build()
+        # one pass over the packed coordinates: the distance to a rectangle
+        # is the sum of the horizontal and vertical gaps (zero for the axes
+        # on which the point is within the rectangle's span)
+        best = None
+        mindist = 0
+        rows = zip(self._objs, *self._coords)
+        for i, (obj, l, t, r, b) in enumerate(rows):
+            if obj is None:
+                continue    # removed object
+            if l < x < r and t < y < b:
+                continue    # the point is inside; at() finds those
+            dx = l - x if l >= x else x - r if r <= x else 0
+            dy = t - y if t >= y else y - b if b <= y else 0
+            d = dx + dy
+            if best is None or d < mindist:
+                mindist = d
+                best = i
+        return self._remember(('nearest', x, y),
+                              self._objs[best] if best is not None else None)
 
     def __len__(self):
         """Return the number of objects."""
@@ -251,6 +302,19 @@ class Rectangles:
         return iter(self._items)
 
     # private helper methods
+    def _remember(self, key, result):
+        """Stores a query result in the cache and returns it.
+
+        The cache is small; when it is full the oldest entry is evicted.
+        It is emptied whenever an object is added or removed.
+
+        """
+        cache = self._cache
+        if len(cache) >= 64:
+            del cache[next(iter(cache))]
+        cache[key] = result
+        return result
+
     def _test(self, *tests):
         """Performs tests and returns objects that fulfill all of them.
 
@@ -259,39 +323,87 @@ class Rectangles:
         Returns a (possibly empty) set.
 
         """
-        meth, side, value = tests[0]
-        result = set(meth(side, value))
-        if result:
-            for meth, side, value in tests[1:]:
-                result &= set(meth(side, value))
-                if not result:
+        smaller = self._smaller
+        ranges = []
+        for meth, side, value in tests:
+            order, start, stop = meth(side, value)
+            if start == stop:
+                return set()    # one test yields nothing, so the AND is empty
+            ranges.append((stop - start, start, stop, order, side, value,
+                           meth == smaller))
+        # walk the smallest candidate range and check the other conditions
+        # directly on the coordinate columns, which beats intersecting the
+        # larger ranges as sets at every selectivity
+        ranges.sort(key=lambda r: r[0])
+        count, start, stop, order = ranges[0][:4]
+        checks = [(self._coords[side], value, issmaller)
+                  for count, start_, stop_, order_, side, value, issmaller
+                  in ranges[1:]]
+        objs = self._objs
+        result = set()
+        for k in range(start, stop):
+            i = order[k]
+            for col, value, issmaller in checks:
+                if (col[i] > value) if issmaller else (col[i] < value):
                     break
+            else:
+                result.add(objs[i])
         return result
 
     def _smaller(self, side, value):
-        """Returns objects for side below value."""
-        indices, objects = self._sorted(side)
-        i = bisect.bisect_right(indices, value)
-        return objects[:i]
+        """Returns the range of objects whose side is below value.
+
+        The range is returned as a three-tuple (order, start, stop), where
+        order is the index list of the side; no copy is made.
+
+        """
+        values, order = self._sorted(side)
+        return order, 0, bisect_right(values, value)
 
     def _larger(self, side, value):
-        """Returns objects for side above value."""
-        indices, objects = self._sorted(side)
-        i = bisect.bisect_left(indices, value)
-        return objects[i:]
+        """Returns the range of objects whose side is above value. See _smaller()."""
+        values, order = self._sorted(side)
+        return order, bisect_left(values, value), len(order)
 
     def _sorted(self, side):
-        """Returns a two-tuple (indices, objects) sorted on index for the given side."""
+        """Returns a two-tuple (values, order) for the given side.
+
+        values is the list of coordinates of that side of all objects in
+        ascending order, order the list of corresponding object indices.
+
+        """
+        if self._objs is None:
+            self._build()
         try:
             return self._index[side]
         except KeyError:
-            if self._items:
-                objects = [(coords[side], obj) for obj, coords in self._items.items()]
-                objects.sort(key=operator.itemgetter(0))
-                result = tuple(map(list, zip(*objects)))
-            else:
-                result = [], []
+            col = self._coords[side]
+            objs = self._objs
+            order = [i for i in range(len(col)) if objs[i] is not None]
+            order.sort(key=col.__getitem__)
+            result = (array.array('d', map(col.__getitem__, order)), order)
             self._index[side] = result
             return result
 
+    def _build(self):
+        """Builds the packed coordinate storage."""
+        items = self._items
+        objs = list(items)
+        if len(objs) > 1:
+            # store the objects in Hilbert curve order of their centers, so
+            # that objects close together in space get nearby indices and
+            # range queries yield clustered candidate sets
+            points = [(c[Left] + c[Right], c[Top] + c[Bottom])
+                      for c in map(items.__getitem__, objs)]
+            (x0, x1), (y0, y1) = [(min(v), max(v)) for v in zip(*points)]
+            fx = 255 / (x1 - x0) if x1 > x0 else 0
+            fy = 255 / (y1 - y0) if y1 > y0 else 0
+            key = {obj: _hilbert(int((px - x0) * fx), int((py - y0) * fy))
+                   for obj, (px, py) in zip(objs, points)}
+            objs.sort(key=key.__getitem__)
+        self._objs = objs
+        self._coords = [array.array('d', (items[o][side] for o in objs))
+                        for side in (Left, Top, Right, Bottom)]
+        self._ids = dict(zip(objs, range(len(objs))))
+
 